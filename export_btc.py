@@ -4,146 +4,293 @@ Exporta histórico COMPLETO do BTC-USD desde 2014 para CSV.
 Estratégia: Mescla múltiplas fontes para garantir histórico máximo.
 """
 
+import math
+import numpy as np
+import os
 import pandas as pd
+import requests
 import sys
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import yfinance as yf
+except ImportError:
+    yf = None
+
+# Seleções de colunas viram views preguiçosas em vez de cópias
+pd.options.mode.copy_on_write = True
 
 CSV_FILE = "btc_prices.csv"
+PARQUET_FILE = "btc_prices.parquet"
+
+# Cache por (source, date) das respostas de cada fonte
+CACHE_FILE = "btc_cache.parquet"
+# Dias até forçar uma nova busca completa em todas as fontes
+CACHE_TTL_DAYS = 7
+# Yahoo tem BTC-USD desde 2014-09-17: cache que começa depois está incompleto
+HISTORY_START = date(2014, 9, 17)
+
+def load_cache():
+    """
+    Carrega o cache por fonte (Parquet) para buscar só os dias novos.
+    """
+    if not os.path.exists(CACHE_FILE):
+        print(f"ℹ️ Sem cache local ({CACHE_FILE}), baixando histórico completo")
+        return None
+    
+    try:
+        cache = pd.read_parquet(CACHE_FILE, engine="pyarrow")
+        
+        missing = {"source", "date", "Open", "Close"} - set(cache.columns)
+        if missing:
+            raise ValueError(f"colunas ausentes: {sorted(missing)}")
+        if cache.empty:
+            raise ValueError("cache vazio")
+        if cache["date"].dtype != object:
+            # Datas salvas como timestamp: volta para objetos date como as fontes
+            cache["date"] = pd.to_datetime(cache["date"]).dt.date
+        
+        print(f"💾 Cache: {len(cache)} linhas, até {cache['date'].max()}")
+        return cache
+        
+    except Exception as e:
+        print(f"⚠️ Cache ilegível, ignorando: {e}")
+        return None
 
-def fetch_btc_yfinance():
+def cache_is_fresh(cache):
+    """
+    O cache só serve para busca incremental se a última busca completa
+    tem menos de CACHE_TTL_DAYS e o histórico começa até HISTORY_START.
+    """
+    try:
+        full_refresh = date.fromisoformat(cache.attrs["full_refresh"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    
+    age = (datetime.now(timezone.utc).date() - full_refresh).days
+    return age < CACHE_TTL_DAYS and cache["date"].min() <= HISTORY_START
+
+def save_cache(cache):
+    """
+    Salva o cache por fonte para a próxima execução.
+    """
+    try:
+        cache.to_parquet(CACHE_FILE, index=False, engine="pyarrow")
+        print(f"💾 Cache salvo: {CACHE_FILE} ({len(cache)} linhas)")
+        
+    except Exception as e:
+        # Sem cache a próxima execução só faz a busca completa
+        print(f"⚠️ Erro ao salvar cache: {e}")
+
+def fetch_btc_yfinance(start_date=None, log=print):
     """
     Yahoo Finance: Tenta pegar histórico completo desde 2014.
+    Com start_date, busca apenas a partir dessa data.
     """
-    print("📡 Tentando Yahoo Finance...")
+    log("📡 Tentando Yahoo Finance...")
     
     try:
-        import yfinance as yf
+        if yf is None:
+            raise ImportError("yfinance não está instalado")
         
         # Força download do máximo histórico possível
         # Yahoo tem BTC-USD desde 2014-09-17
         btc = yf.Ticker("BTC-USD")
         
-        # Método 1: history com period="max"
-        print("   Método 1: period='max'")
-        df = btc.history(period="max", interval="1d")
+        if start_date is None:
+            # Método 1: history com period="max"
+            log("   Método 1: period='max'")
+            df = btc.history(period="max", interval="1d")
+        else:
+            log(f"   Método 1: a partir de {start_date}")
+            df = btc.history(start=start_date, interval="1d")
         
         if df.empty:
             # Método 2: download com datas específicas
-            print("   Método 2: datas específicas")
-            df = yf.download("BTC-USD", start="2010-01-01", end=datetime.now(), progress=False)
+            log("   Método 2: datas específicas")
+            df = yf.download("BTC-USD", start=start_date or "2010-01-01", end=datetime.now(), progress=False)
         
         if df.empty:
             raise ValueError("Yahoo retornou vazio")
         
-        # Normaliza formato
+        # Normaliza formato (o índice já é DatetimeIndex, sem reconverter)
         df = df.reset_index()
-        df['Date'] = pd.to_datetime(df['Date']).dt.date
-        df = df.rename(columns={'Date': 'date'})
+        df['date'] = df['Date'].dt.date
         
-        result = df[['date', 'Open', 'Close']].copy()
-        result = result.dropna()
+        result = df[['date', 'Open', 'Close']].dropna()
         
-        print(f"✅ Yahoo Finance: {len(result)} dias")
-        print(f"   📅 Período: {result['date'].min()} até {result['date'].max()}")
+        log(f"✅ Yahoo Finance: {len(result)} dias")
+        log(f"   📅 Período: {result['date'].min()} até {result['date'].max()}")
         
         return result
         
     except Exception as e:
-        print(f"❌ Yahoo Finance falhou: {e}")
+        log(f"❌ Yahoo Finance falhou: {e}")
         return None
 
-def fetch_btc_cryptocompare():
+def fetch_btc_cryptocompare(start_date=None, log=print):
     """
     CryptoCompare: Histórico completo em múltiplas chamadas.
-    Suporta até 2000 dias por chamada, então fazemos múltiplas.
+    Suporta até 2000 dias por chamada, então fazemos múltiplas em paralelo.
+    Com start_date, faz só os batches necessários para cobrir o intervalo.
     """
-    print("📡 Tentando CryptoCompare (histórico completo)...")
+    if start_date is None:
+        log("📡 Tentando CryptoCompare (histórico completo)...")
+    else:
+        log(f"📡 Tentando CryptoCompare (a partir de {start_date})...")
     
     try:
-        import requests
-        from datetime import timedelta
-        
         url = "https://min-api.cryptocompare.com/data/v2/histoday"
         
-        all_data = []
+        # Sem cache, pega desde 2010 (antes do BTC existir no mercado moderno).
+        # Tudo em UTC: os candles diários da API começam à meia-noite UTC
+        end_date = datetime.now(timezone.utc)
+        if start_date is None:
+            start = datetime(2010, 1, 1, tzinfo=timezone.utc)
+        else:
+            start = datetime.combine(start_date, datetime.min.time(), tzinfo=timezone.utc)
+        
+        # As janelas de 2000 dias são determinísticas: calcula todos os
+        # toTs de antemão em vez de encadear no último timestamp retornado.
+        # Cada janela termina no último dia antes da seguinte começar,
+        # então os batches não se sobrepõem.
+        batch_secs = 2000 * 86400
+        start_ts = start.timestamp()
+        end_ts = end_date.timestamp()
+        n_batches = math.ceil((end_ts - start_ts) / batch_secs)
+        to_ts_list = [
+            int(min(start_ts + (i + 1) * batch_secs - 86400, end_ts))
+            for i in range(n_batches)
+        ]
+        
+        # Pausa compartilhada: quando um worker vê a cota no fim, todos
+        # esperam antes da próxima requisição
+        pause_lock = threading.Lock()
+        pause_until = 0.0
         
-        # Pega desde 2010 (antes do BTC existir no mercado moderno)
-        end_date = datetime.now()
-        current_date = datetime(2010, 1, 1)
+        def pause(seconds):
+            nonlocal pause_until
+            with pause_lock:
+                pause_until = max(pause_until, time.monotonic() + seconds)
         
-        batch_num = 0
-        while current_date < end_date:
-            batch_num += 1
-            to_ts = int(min(current_date.timestamp() + (2000 * 86400), end_date.timestamp()))
+        def wait_pause():
+            with pause_lock:
+                delay = pause_until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        
+        def get_histoday(params):
+            for _ in range(3):
+                wait_pause()
+                r = session.get(url, params=params, timeout=30)
+                r.raise_for_status()
+                
+                data = r.json()
+                
+                # Evita rate limit: só pausa quando a cota está no fim. A
+                # CryptoCompare sinaliza limite estourado com Response "Error"
+                # (HTTP 200), que o Retry da sessão não cobre: repete aqui
+                rate_limited = "rate limit" in str(data.get("Message", "")).lower()
+                remaining = r.headers.get("X-RateLimit-Remaining", "")
+                if rate_limited or (remaining.isdigit() and int(remaining) <= 5):
+                    retry_after = r.headers.get("Retry-After", "")
+                    pause(int(retry_after) if retry_after.isdigit() else 1)
+                
+                if data.get("Response") == "Success":
+                    return data.get("Data", {}).get("Data", [])
+                if not rate_limited:
+                    break
             
+            # Página faltando deixaria um buraco no histórico: falha a fonte
+            raise ValueError(f"CryptoCompare: {data.get('Message', 'resposta inválida')}")
+        
+        def fetch_batch(batch_num, to_ts):
+            # A API devolve limit + 1 dias terminando em toTs; o último
+            # batch costuma ser parcial, então pede só os dias que faltam
+            # (mínimo 1, exigido pela API: rerun no mesmo dia daria 0)
+            from_ts = start_ts + (batch_num - 1) * batch_secs
             params = {
                 "fsym": "BTC",
                 "tsym": "USD",
-                "limit": 2000,
+                "limit": max(1, int((to_ts - from_ts) // 86400)),
                 "toTs": to_ts
             }
             
-            print(f"   Batch {batch_num}: até {datetime.fromtimestamp(to_ts).date()}")
-            
-            r = requests.get(url, params=params, timeout=30)
-            r.raise_for_status()
-            
-            data = r.json()
-            if data.get("Response") != "Success":
-                break
-            
-            prices = data.get("Data", {}).get("Data", [])
-            if not prices:
-                break
+            log(f"   Batch {batch_num}: até {datetime.fromtimestamp(to_ts, timezone.utc).date()}")
             
-            all_data.extend(prices)
+            return get_histoday(params)
+        
+        # A sessão compartilhada reaproveita as conexões TLS entre chamadas
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+        with requests.Session() as session:
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry))
             
-            # Próximo batch
-            last_ts = prices[-1]["time"]
-            current_date = datetime.fromtimestamp(last_ts) + timedelta(days=1)
+            all_data = []
+            if n_batches > 1:
+                # allData=true devolve o histórico inteiro em uma chamada
+                # Erros (inclusive de rate limit) derrubam a fonte em vez de
+                # disparar logo em seguida a paginação completa
+                log("   allData: histórico completo em uma chamada")
+                try:
+                    all_data = get_histoday({"fsym": "BTC", "tsym": "USD", "allData": "true"})
+                except (requests.RequestException, ValueError) as e:
+                    log(f"   allData falhou: {e}")
+                    raise
+                
+                # Resposta truncada (só uma página): cai na paginação
+                if len(all_data) <= 2001:
+                    log(f"   allData truncado ({len(all_data)} dias), paginando")
+                    all_data = []
             
-            # Evita rate limit
-            import time
-            time.sleep(0.5)
+            if not all_data:
+                # Busca todos os batches em paralelo; 4 workers para não
+                # estourar o limite de requisições do plano gratuito
+                with ThreadPoolExecutor(max_workers=4) as ex:
+                    batches = ex.map(fetch_batch, range(1, n_batches + 1), to_ts_list)
+                    all_data = [item for prices in batches for item in prices]
         
         if not all_data:
             raise ValueError("CryptoCompare retornou vazio")
         
         # Processa dados
-        rows = []
-        for item in all_data:
-            if item["close"] > 0:  # Só dias com preço válido
-                date = datetime.fromtimestamp(item["time"]).date()
-                rows.append({
-                    "date": date,
-                    "Open": float(item["open"]),
-                    "Close": float(item["close"])
-                })
+        df = pd.DataFrame(all_data)
+        df["date"] = pd.to_datetime(df["time"], unit="s").dt.date
+        df = df.rename(columns={"open": "Open", "close": "Close"})
         
-        result = pd.DataFrame(rows).drop_duplicates("date").sort_values("date")
+        # Só dias com preço válido
+        result = df.loc[df["Close"] > 0, ["date", "Open", "Close"]].sort_values("date")
         
-        print(f"✅ CryptoCompare: {len(result)} dias")
-        print(f"   📅 Período: {result['date'].min()} até {result['date'].max()}")
+        log(f"✅ CryptoCompare: {len(result)} dias")
+        log(f"   📅 Período: {result['date'].min()} até {result['date'].max()}")
         
         return result
         
     except Exception as e:
-        print(f"❌ CryptoCompare falhou: {e}")
+        log(f"❌ CryptoCompare falhou: {e}")
         return None
 
-def fetch_btc_coingecko_free():
+def fetch_btc_coingecko_free(start_date=None, log=print):
     """
     CoinGecko: Últimos 365 dias apenas (endpoint gratuito).
+    Com start_date, pede só os dias desde essa data.
     """
-    print("📡 Tentando CoinGecko (últimos 365 dias)...")
+    log("📡 Tentando CoinGecko...")
     
     try:
-        import requests
+        days = 365
+        if start_date is not None:
+            days = max(1, min(days, (datetime.now(timezone.utc).date() - start_date).days + 1))
+        log(f"   Últimos {days} dias")
         
         url = "https://api.coingecko.com/api/v3/coins/bitcoin/market_chart"
         params = {
             "vs_currency": "usd",
-            "days": "365",
+            "days": str(days),
             "interval": "daily"
         }
         
@@ -158,73 +305,125 @@ def fetch_btc_coingecko_free():
         df = pd.DataFrame(prices, columns=["timestamp", "price"])
         df["date"] = pd.to_datetime(df["timestamp"], unit="ms").dt.date
 
-        grouped = df.groupby("date")["price"]
-        result = pd.DataFrame({
-            "date": grouped.first().index,
-            "Open": grouped.first().values,
-            "Close": grouped.last().values,
-        })
+        # Preços já vêm em ordem cronológica: dispensa o sort do groupby
+        result = df.groupby("date", sort=False)["price"].agg(["first", "last"]).reset_index()
+        result.columns = ["date", "Open", "Close"]
 
-        print(f"✅ CoinGecko: {len(result)} dias")
+        log(f"✅ CoinGecko: {len(result)} dias")
         
         return result
         
     except Exception as e:
-        print(f"❌ CoinGecko falhou: {e}")
+        log(f"❌ CoinGecko falhou: {e}")
         return None
 
-def merge_sources():
+# Fontes em ordem de prioridade
+SOURCES = [
+    ("Yahoo", fetch_btc_yfinance),
+    ("CryptoCompare", fetch_btc_cryptocompare),
+    ("CoinGecko", fetch_btc_coingecko_free),
+]
+
+def merge_sources(cache=None):
     """
     Mescla dados de múltiplas fontes para maximizar o histórico.
     Prioridade: Yahoo > CryptoCompare > CoinGecko
+    Com cache válido, cada fonte busca só a partir do seu último dia salvo;
+    a prioridade é reaplicada sobre o cache inteiro a cada execução.
+    Retorna (merged, cache atualizado).
     """
     print("\n" + "=" * 50)
     print("🔗 MESCLANDO MÚLTIPLAS FONTES")
     print("=" * 50)
     
-    sources = []
+    incremental = cache is not None and cache_is_fresh(cache)
+    if cache is not None and not incremental:
+        print("♻️ Cache expirado ou incompleto, buscando histórico completo")
     
-    # Tenta todas as fontes
-    df_yahoo = fetch_btc_yfinance()
-    if df_yahoo is not None and not df_yahoo.empty:
-        sources.append(("Yahoo", df_yahoo))
+    # Rebusca o último dia de cada fonte: ele pode ter sido salvo incompleto
+    start_dates = {name: None for name, _ in SOURCES}
+    if incremental:
+        last = cache.groupby("source")["date"].max()
+        for name in start_dates:
+            start_dates[name] = last.get(name)
     
-    df_crypto = fetch_btc_cryptocompare()
-    if df_crypto is not None and not df_crypto.empty:
-        sources.append(("CryptoCompare", df_crypto))
+    # Tenta todas as fontes em paralelo (são todas limitadas por rede).
+    # Cada fonte acumula o próprio log para não intercalar as saídas.
+    results = {}
+    logs = {name: [] for name, _ in SOURCES}
+    with ThreadPoolExecutor(max_workers=len(SOURCES)) as ex:
+        futs = {
+            ex.submit(fn, start_dates[name], logs[name].append): name
+            for name, fn in SOURCES
+        }
+        for f in as_completed(futs):
+            results[futs[f]] = f.result()
     
-    df_gecko = fetch_btc_coingecko_free()
-    if df_gecko is not None and not df_gecko.empty:
-        sources.append(("CoinGecko", df_gecko))
+    # Mantém a ordem de prioridade, independente de quem terminou primeiro
+    sources = []
+    for name, _ in SOURCES:
+        print("\n".join(logs[name]))
+        df = results.get(name)
+        if df is not None and not df.empty:
+            sources.append((name, df))
     
     if not sources:
-        print("❌ Nenhuma fonte retornou dados!")
-        return None
+        if cache is None:
+            print("❌ Nenhuma fonte retornou dados!")
+            return None, None
+        print("⚠️ Nenhuma fonte retornou dados, usando só o cache")
+    
+    # Atualiza o cache por fonte: dados novos têm prioridade sobre o cache
+    # nas datas repetidas. Empilha coluna a coluna: evita o concat do
+    # BlockManager e preserva o dtype de cada coluna (vstack viraria object)
+    cols = ["source", "date", "Open", "Close"]
+    frames = [df.assign(source=name) for name, df in sources]
+    if cache is not None:
+        frames.append(cache)
+    new_cache = pd.DataFrame({
+        c: np.concatenate([df[c].to_numpy() for df in frames])
+        for c in cols
+    })
+    new_cache = new_cache.drop_duplicates(["source", "date"]).reset_index(drop=True)
     
-    # Mescla todas as fontes
-    print(f"\n📊 Mesclando {len(sources)} fontes...")
+    # Só marca busca completa quando ela de fato trouxe dados
+    if sources and not incremental:
+        new_cache.attrs["full_refresh"] = datetime.now(timezone.utc).date().isoformat()
+    elif "full_refresh" in cache.attrs:
+        new_cache.attrs["full_refresh"] = cache.attrs["full_refresh"]
     
-    all_dfs = [df for _, df in sources]
-    merged = pd.concat(all_dfs, ignore_index=True)
+    # Mescla todas as fontes (as que falharam agora entram pelo cache)
+    suffix = " + cache" if cache is not None else ""
+    print(f"\n📊 Mesclando {len(sources)} fontes{suffix}...")
     
-    # Remove duplicatas, mantendo a primeira ocorrência (prioridade Yahoo)
-    merged = merged.drop_duplicates(subset="date", keep="first")
-    merged = merged.sort_values("date").reset_index(drop=True)
+    # Encadeia combine_first na ordem de prioridade (Yahoo > CryptoCompare >
+    # CoinGecko): fontes seguintes só preenchem datas/campos faltantes.
+    # O cache já é único por (source, date), como combine_first exige
+    merged = None
+    for name, _ in SOURCES:
+        df = new_cache.loc[new_cache["source"] == name, ["date", "Open", "Close"]]
+        if df.empty:
+            continue
+        indexed = df.set_index("date")
+        merged = indexed if merged is None else merged.combine_first(indexed)
+    merged = merged.sort_index().reset_index()
     
     print(f"\n✅ RESULTADO FINAL:")
     print(f"   Total: {len(merged)} dias únicos")
     print(f"   📅 Período: {merged['date'].min()} até {merged['date'].max()}")
     
     # Mostra contribuição de cada fonte
+    merged_idx = pd.Index(merged['date'])
     for source_name, source_df in sources:
-        overlap = len(set(source_df['date'].values) & set(merged['date'].values))
+        overlap = int(source_df['date'].isin(merged_idx).sum())
         print(f"   - {source_name}: {overlap} dias na base final")
     
-    return merged
+    return merged, new_cache
 
-def save_csv(df):
+def save_csv(df, validate_csv=False):
     """
-    Salva DataFrame em CSV e valida.
+    Salva DataFrame em CSV e Parquet e valida.
+    A validação relê o Parquet; o CSV só é relido com validate_csv=True.
     """
     if df is None or df.empty:
         print("❌ ERRO: DataFrame vazio, não salvando CSV")
@@ -234,8 +433,23 @@ def save_csv(df):
         df.to_csv(CSV_FILE, index=False)
         print(f"\n✅ CSV salvo: {CSV_FILE}")
         
-        # Validação
-        test = pd.read_csv(CSV_FILE)
+        df.to_parquet(PARQUET_FILE, index=False, engine="pyarrow")
+        print(f"✅ Parquet salvo: {PARQUET_FILE}")
+        
+        # Validação (Parquet evita reinterpretar o texto recém-escrito)
+        test = pd.read_parquet(PARQUET_FILE, engine="pyarrow")
+        
+        if validate_csv:
+            csv_test = pd.read_csv(
+                CSV_FILE,
+                usecols=["date", "Open", "Close"],
+                dtype={"Open": "float64", "Close": "float64"},
+                parse_dates=["date"],
+                engine="pyarrow",
+            )
+            csv_rows = len(csv_test)
+            if csv_rows != len(test):
+                raise ValueError(f"CSV tem {csv_rows} linhas, Parquet tem {len(test)}")
         
         print(f"✅ Validação:")
         print(f"   - Linhas: {len(test)}")
@@ -245,13 +459,12 @@ def save_csv(df):
         if len(test) < 365:
             print(f"⚠️ AVISO: Menos de 1 ano de dados ({len(test)} dias)")
         
-        # Verifica anos disponíveis
-        test['year'] = pd.to_datetime(test['date']).dt.year
-        years = sorted(test['year'].unique())
+        # Verifica anos disponíveis (o Parquet já devolve objetos date)
+        years = sorted({d.year for d in test['date']})
         print(f"   - Anos disponíveis: {years[0]} até {years[-1]} ({len(years)} anos)")
         
     except Exception as e:
-        print(f"❌ Erro ao salvar/validar CSV: {e}")
+        print(f"❌ Erro ao salvar/validar arquivos: {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -259,8 +472,10 @@ if __name__ == "__main__":
     print("🚀 EXPORTAÇÃO BTC - HISTÓRICO COMPLETO")
     print("=" * 50)
     
-    df = merge_sources()
-    save_csv(df)
+    df, cache = merge_sources(load_cache())
+    save_csv(df, validate_csv="--validate-csv" in sys.argv)
+    if cache is not None:
+        save_cache(cache)
     
     print("\n" + "=" * 50)
     print("✅ Exportação concluída!")